@@ -8,7 +8,9 @@ from flask_swagger import swagger
 from flask_cors import CORS
 from utils import APIException, generate_sitemap
 from admin import setup_admin
+from sql_profiler import setup_sql_profiler
 from models import db, User, People, Planet, Favorite
+from favorite_queue import FavoriteWriteQueue, ADD, DELETE
 # from models import Person
 
 app = Flask(__name__)
@@ -26,6 +28,16 @@ MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
 setup_admin(app)
+setup_sql_profiler(app)
+
+# Optional write-behind mode for favorites, see src/favorite_queue.py
+favorite_queue = None
+if os.getenv("FAVORITES_WRITE_BEHIND") == "1":
+    favorite_queue = FavoriteWriteQueue(
+        app,
+        flush_interval=float(os.getenv("FAVORITES_FLUSH_INTERVAL", 0.5)),
+        max_batch=int(os.getenv("FAVORITES_FLUSH_BATCH", 100))
+    )
 
 # Handle/serialize errors like a JSON object
 
@@ -203,22 +215,43 @@ def delete_planet(planet_id):
 
 @app.route("/users/favorites", methods=["GET"])
 def get_user_favorites():
+    # Changes still waiting in the write-behind queue, applied on top of the
+    # database rows so you always see your own writes. Read before the rows:
+    # if a flush commits in between, its adds are in the rows and `seen`
+    # skips them.
+    pending = {}
+    if favorite_queue is not None:
+        pending = favorite_queue.pending_ops(CURRENT_USER_ID)
+
     favorites = Favorite.query.filter_by(user_id=CURRENT_USER_ID).all()
 
     results = []
+    seen = set()
 
     for fav in favorites:
-        if fav.people:
+        if fav.people and pending.get(("people", fav.people_id)) != DELETE:
+            seen.add(("people", fav.people_id))
             results.append({
                 "type": "people",
                 "data": fav.people.serialize()
             })
-        if fav.planet:
+        if fav.planet and pending.get(("planet", fav.planet_id)) != DELETE:
+            seen.add(("planet", fav.planet_id))
             results.append({
                 "type": "planet",
                 "data": fav.planet.serialize()
             })
 
+    for (kind, target_id), op in pending.items():
+        if op != ADD or (kind, target_id) in seen:
+            continue
+        item = (People if kind == "people" else Planet).query.get(target_id)
+        if item:
+            results.append({
+                "type": kind,
+                "data": item.serialize()
+            })
+
     return jsonify(results), 200
 
 
@@ -230,6 +263,11 @@ def add_favorite_planet(planet_id):
     if not planet:
         return jsonify({"msg": "El planeta no existe"}), 404
 
+    if favorite_queue is not None:
+        if not favorite_queue.set_favorite(CURRENT_USER_ID, "planet", planet_id, ADD):
+            return jsonify({"msg": "El planeta ya está en favoritos"}), 409
+        return jsonify({"msg": "Planeta agregado a favoritos"}), 202
+
     exists = Favorite.query.filter_by(
         user_id=CURRENT_USER_ID,
         planet_id=planet_id
@@ -258,6 +296,11 @@ def add_favorite_people(people_id):
     if not person:
         return jsonify({"msg": "El personaje no existe"}), 404
 
+    if favorite_queue is not None:
+        if not favorite_queue.set_favorite(CURRENT_USER_ID, "people", people_id, ADD):
+            return jsonify({"msg": "El personaje ya está en favoritos"}), 409
+        return jsonify({"msg": "Personaje agregado a favoritos"}), 202
+
     exists = Favorite.query.filter_by(
         user_id=CURRENT_USER_ID,
         people_id=people_id
@@ -282,6 +325,11 @@ def add_favorite_people(people_id):
 
 @app.route("/favorite/planet/<int:planet_id>", methods=["DELETE"])
 def delete_favorite_planet(planet_id):
+    if favorite_queue is not None:
+        if not favorite_queue.set_favorite(CURRENT_USER_ID, "planet", planet_id, DELETE):
+            return jsonify({"msg": "Favorito no existe"}), 404
+        return jsonify({"msg": "Planeta eliminado de favoritos"}), 202
+
     fav = Favorite.query.filter_by(
         user_id=CURRENT_USER_ID,
         planet_id=planet_id
@@ -301,6 +349,11 @@ def delete_favorite_planet(planet_id):
 
 @app.route("/favorite/people/<int:people_id>", methods=["DELETE"])
 def delete_favorite_people(people_id):
+    if favorite_queue is not None:
+        if not favorite_queue.set_favorite(CURRENT_USER_ID, "people", people_id, DELETE):
+            return jsonify({"msg": "Favorito no existe"}), 404
+        return jsonify({"msg": "Personaje eliminado de favoritos"}), 202
+
     fav = Favorite.query.filter_by(
         user_id=CURRENT_USER_ID,
         people_id=people_id
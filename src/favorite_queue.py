@@ -0,0 +1,281 @@
+"""
+Write-behind queue for favorite add/remove operations.
+
+When enabled (FAVORITES_WRITE_BEHIND=1) the favorite endpoints do not commit
+on every request. Mutations are kept in memory and written to the database
+in a single transaction every FAVORITES_FLUSH_INTERVAL seconds or as soon as
+FAVORITES_FLUSH_BATCH operations are pending, whichever comes first.
+
+Durability: a request answered with 202 is only in memory until the next
+flush. Pending operations are flushed by an atexit hook when the process
+exits normally:
+
+- gunicorn workers and the flask reloader turn SIGTERM into a normal exit.
+- `python src/app.py` and `flask run` get a SIGTERM handler installed here
+  that does the same, as long as nothing else has installed one before.
+- SIGKILL, a crash or a gunicorn worker timeout lose up to one interval /
+  batch of acknowledged operations.
+
+If one operation of a batch can't be written (e.g. the planet was deleted
+in the meantime) the batch is retried one operation at a time and the broken
+ones are dropped and logged. Operations that fail because the database is
+unavailable (or any other error) are requeued up to MAX_RETRIES times.
+
+The queue lives inside one process, so every gunicorn worker keeps its own.
+The flush thread is started on the first enqueue of each process, so it also
+works with `gunicorn --preload`.
+"""
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError, SQLAlchemyError
+from models import db, Favorite
+
+logger = logging.getLogger(__name__)
+
+ADD = "add"
+DELETE = "delete"
+
+# How many failed flushes an operation survives before it is dropped
+MAX_RETRIES = 5
+
+# kind -> Favorite column holding the target id
+TARGET_COLUMNS = {
+    "planet": "planet_id",
+    "people": "people_id",
+}
+
+
+class FavoriteWriteQueue:
+
+    def __init__(self, app, flush_interval=0.5, max_batch=100):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # Only held while reading or swapping the dicts below, never while
+        # talking to the database
+        self._lock = threading.Lock()
+        # Only one flush writes at a time
+        self._flush_lock = threading.Lock()
+        # (user_id, kind, target_id) -> ADD / DELETE, only the net operation
+        self._pending = {}
+        # Operations taken by the flush that is writing right now
+        self._inflight = {}
+        # (user_id, kind, target_id) -> failed flushes so far
+        self._retries = {}
+        # Bumped every time a flush finishes, see set_favorite()
+        self._flushes = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        atexit.register(self.shutdown)
+        _install_sigterm_handler()
+
+    def start(self):
+        with self._lock:
+            # After a fork the thread of the parent doesn't exist in the child
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="favorite-write-behind", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval * 2)
+        self._thread = None
+        self.flush()
+
+    def pending_ops(self, user_id):
+        """(kind, target_id) -> ADD / DELETE not yet committed for a user."""
+        with self._lock:
+            merged = {**self._inflight, **self._pending}
+        return {
+            (kind, target_id): op
+            for (uid, kind, target_id), op in merged.items()
+            if uid == user_id
+        }
+
+    def set_favorite(self, user_id, kind, target_id, op):
+        """
+        Queue an ADD or DELETE. Returns False without queueing anything when
+        the favorite is already in that state (add twice, delete a missing one).
+        """
+        key = (user_id, kind, target_id)
+        while True:
+            exists, flushes = self._state(key)
+            with self._lock:
+                if key in self._pending or key in self._inflight:
+                    exists = self._overlay(key)
+                elif self._flushes != flushes:
+                    # A flush committed while we were reading, read again
+                    continue
+                if exists == (op == ADD):
+                    return False
+                self._merge(key, op)
+                full = len(self._pending) >= self.max_batch
+            break
+
+        self.start()
+        if full:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = self._pending
+                self._pending = {}
+                self._inflight = batch
+
+            # Anything _write() didn't report as written goes back to the
+            # queue, even if it blew up with an error it doesn't know about
+            written, failed = [], dict(batch)
+            try:
+                written, failed = self._write(batch)
+            finally:
+                self._finish_flush(written, failed)
+            return len(written)
+
+    def _finish_flush(self, written, failed):
+        with self._lock:
+            self._inflight = {}
+            self._flushes += 1
+            for key, op in failed.items():
+                self._retries[key] = self._retries.get(key, 0) + 1
+                if self._retries[key] > MAX_RETRIES:
+                    logger.error("Dropping favorite %s %s after %d retries",
+                                 op, key, MAX_RETRIES)
+                    del self._retries[key]
+                    continue
+                self._merge(key, op, newer=False)
+            for key in written:
+                self._retries.pop(key, None)
+
+    def _state(self, key):
+        # Database state with the pending operations applied on top
+        with self._lock:
+            flushes = self._flushes
+            if key in self._pending or key in self._inflight:
+                return self._overlay(key), flushes
+
+        user_id, kind, target_id = key
+        exists = Favorite.query.filter(_match(user_id, kind, target_id)).first() is not None
+        return exists, flushes
+
+    def _overlay(self, key):
+        return self._pending.get(key, self._inflight.get(key)) == ADD
+
+    def _merge(self, key, op, newer=True):
+        # An add followed by a delete (or the other way around) before the
+        # flush cancels out, the database is already in that state. An op
+        # that is requeued (newer=False) goes underneath the pending one.
+        if key in self._pending and self._pending[key] != op:
+            del self._pending[key]
+        elif newer or key not in self._pending:
+            self._pending[key] = op
+
+    def _write(self, batch):
+        """Returns (written keys, failed ops to retry)."""
+        try:
+            with self.app.app_context():
+                self._commit(batch)
+            return list(batch), {}
+        except OperationalError:
+            logger.exception("Database unavailable, requeueing %d favorite operations", len(batch))
+            return [], dict(batch)
+        except DBAPIError:
+            logger.warning("Batch of %d favorite operations failed, retrying one by one", len(batch))
+        except SQLAlchemyError:
+            # e.g. TimeoutError when the pool has no free connection
+            logger.exception("Could not flush, requeueing %d favorite operations", len(batch))
+            return [], dict(batch)
+
+        written, failed = [], {}
+        for key, op in batch.items():
+            try:
+                with self.app.app_context():
+                    self._commit({key: op})
+                written.append(key)
+            except IntegrityError:
+                logger.exception("Dropping favorite %s %s", op, key)
+            except SQLAlchemyError:
+                logger.exception("Requeueing favorite %s %s", op, key)
+                failed[key] = op
+        return written, failed
+
+    def _commit(self, batch):
+        adds = [key for key, op in batch.items() if op == ADD]
+        deletes = [key for key, op in batch.items() if op == DELETE]
+
+        try:
+            if deletes:
+                Favorite.query.filter(or_(*[
+                    _match(user_id, kind, target_id)
+                    for user_id, kind, target_id in deletes
+                ])).delete(synchronize_session=False)
+
+            if adds:
+                # One query to skip rows that already exist instead of one per add
+                existing = Favorite.query.filter(or_(*[
+                    _match(user_id, kind, target_id)
+                    for user_id, kind, target_id in adds
+                ])).all()
+                existing_keys = set()
+                for fav in existing:
+                    for kind, column in TARGET_COLUMNS.items():
+                        target_id = getattr(fav, column)
+                        if target_id is not None:
+                            existing_keys.add((fav.user_id, kind, target_id))
+
+                db.session.add_all([
+                    Favorite(user_id=user_id, **{TARGET_COLUMNS[kind]: target_id})
+                    for user_id, kind, target_id in adds
+                    if (user_id, kind, target_id) not in existing_keys
+                ])
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Favorite flush failed")
+
+
+def _match(user_id, kind, target_id):
+    column = getattr(Favorite, TARGET_COLUMNS[kind])
+    return and_(Favorite.user_id == user_id, column == target_id)
+
+
+def _exit_on_sigterm(signum, frame):
+    # Turn SIGTERM into a normal exit so the atexit flush runs
+    sys.exit(0)
+
+
+def _install_sigterm_handler():
+    # Leave alone servers (gunicorn, the flask reloader) that handle it already
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
@@ -0,0 +1,190 @@
+"""
+Per request SQL profiler and slow query log.
+
+Profiling is turned on for every request with SQL_PROFILER=1, or for a single
+request by sending the header "X-SQL-Profile: 1" (only honored when
+SQL_PROFILER_HEADER=1 or the app runs in debug mode, so it can't be triggered
+from outside in production).
+
+For a profiled request every statement is recorded with its duration and row
+count, and statements that fail with the name of the error. Requests slower than SQL_SLOW_REQUEST_MS and statements slower than
+SQL_SLOW_QUERY_MS are logged as warnings, and slow SELECTs get their EXPLAIN
+plan logged too. A summary is returned in the X-SQL-Profile response header.
+
+Bound parameters are never logged (they can hold passwords), only used to
+run the EXPLAIN. The EXPLAIN runs after the response is built, on its own
+connection, so a failing one can't break the request's transaction.
+
+Row counts come from the driver, and for ORM SELECTs the driver doesn't
+know (sqlite) they are counted from the result instead. Plain SELECTs run
+with db.session.execute(text(...)) on sqlite are logged with rows=None.
+"""
+import logging
+import os
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+HEADER = "X-SQL-Profile"
+
+# dialect name -> prefix used to get the query plan
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+}
+
+
+def setup_sql_profiler(app):
+    app.config.setdefault("SQL_PROFILER", os.getenv("SQL_PROFILER") == "1")
+    app.config.setdefault("SQL_PROFILER_HEADER", os.getenv("SQL_PROFILER_HEADER") == "1")
+    app.config.setdefault("SQL_SLOW_QUERY_MS", float(os.getenv("SQL_SLOW_QUERY_MS", 100)))
+    app.config.setdefault("SQL_SLOW_REQUEST_MS", float(os.getenv("SQL_SLOW_REQUEST_MS", 500)))
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+        event.listen(Session, "do_orm_execute", _count_orm_rows)
+
+    @app.before_request
+    def start_sql_profile():
+        if app.config["SQL_PROFILER"] or _header_enabled(app):
+            g.sql_profile = {
+                "start": time.perf_counter(),
+                "queries": [],
+            }
+
+    @app.after_request
+    def finish_sql_profile(response):
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return response
+
+        total_ms = (time.perf_counter() - profile["start"]) * 1000
+        queries = profile["queries"]
+        sql_ms = sum(q["duration_ms"] for q in queries)
+        slowest_ms = max((q["duration_ms"] for q in queries), default=0)
+
+        _log_slow_queries(queries, app.config["SQL_SLOW_QUERY_MS"])
+
+        response.headers[HEADER] = "queries=%d;sql_ms=%.2f;slowest_ms=%.2f;total_ms=%.2f" % (
+            len(queries), sql_ms, slowest_ms, total_ms)
+
+        if total_ms >= app.config["SQL_SLOW_REQUEST_MS"]:
+            logger.warning("Slow request %s %s: %.2f ms, %d queries, %.2f ms in SQL",
+                           request.method, request.path, total_ms, len(queries), sql_ms)
+            for q in queries:
+                logger.warning("  %s", _describe(q))
+        else:
+            for q in queries:
+                logger.debug("%s", _describe(q))
+
+        return response
+
+
+def _header_enabled(app):
+    if not (app.debug or app.config["SQL_PROFILER_HEADER"]):
+        return False
+    return request.headers.get(HEADER) == "1"
+
+
+def _current_profile():
+    if not has_request_context():
+        return None
+    return g.get("sql_profile")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which goes away with the statement,
+    # so nothing is left behind on the pooled connection
+    if context is not None and _current_profile() is not None:
+        context._sql_profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Some drivers (sqlite) don't know the row count of a SELECT until it's fetched
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    _record(context, statement, rows, None if executemany else (conn.engine, parameters))
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't run for a statement that raised
+    _record(exception_context.execution_context, exception_context.statement, None, None,
+            error=type(exception_context.original_exception).__name__)
+
+
+def _record(context, statement, rows, explain, error=None):
+    profile = _current_profile()
+    start = getattr(context, "_sql_profile_start", None)
+    if profile is None or start is None:
+        return
+    del context._sql_profile_start
+
+    query = {
+        "statement": statement,
+        "duration_ms": (time.perf_counter() - start) * 1000,
+        "rows": rows,
+        # Only used to run the EXPLAIN after the request, never logged
+        "explain": explain,
+    }
+    if error is not None:
+        query["error"] = error
+    profile["queries"].append(query)
+
+
+def _count_orm_rows(orm_execute_state):
+    profile = _current_profile()
+    if (profile is None or not orm_execute_state.is_select
+            or orm_execute_state.execution_options.get("yield_per")):
+        return None
+
+    # Index of the statement run below; freezing the result can run more
+    # (e.g. selectinload), so it isn't necessarily the last one
+    index = len(profile["queries"])
+    result = orm_execute_state.invoke_statement()
+    if len(profile["queries"]) == index or profile["queries"][index]["rows"] is not None:
+        return result
+
+    # The ORM buffers the rows anyway, count them and hand back a copy
+    frozen = result.freeze()
+    profile["queries"][index]["rows"] = len(frozen.data)
+    return frozen()
+
+
+def _log_slow_queries(queries, slow_query_ms):
+    for query in queries:
+        explain = query.pop("explain")
+        if query["duration_ms"] < slow_query_ms:
+            continue
+        logger.warning("Slow query: %s", _describe(query))
+        if explain is not None and query["statement"].lstrip().upper().startswith("SELECT"):
+            query["plan"] = _explain(*explain, query["statement"])
+            if query["plan"]:
+                logger.warning("Query plan:\n%s", query["plan"])
+
+
+def _describe(query):
+    error = " error=" + query["error"] if "error" in query else ""
+    return "%.2f ms rows=%s%s %s" % (
+        query["duration_ms"], query["rows"], error, query["statement"])
+
+
+def _explain(engine, parameters, statement):
+    prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+    if prefix is None:
+        return None
+
+    # A connection of its own, rolled back when closed, so the request's
+    # transaction never sees the EXPLAIN or its errors
+    try:
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+    except Exception:
+        logger.exception("Could not get the query plan")
+        return None
+    return "\n".join(" ".join(str(col) for col in row) for row in rows)
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+# app.py reads its configuration when it's imported
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import app as app_module  # noqa: E402
+from favorite_queue import FavoriteWriteQueue  # noqa: E402
+from models import db, User, Planet, People  # noqa: E402
+
+flask_app = app_module.app
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        if not event.contains(db.engine, "connect", _enable_foreign_keys):
+            event.listen(db.engine, "connect", _enable_foreign_keys)
+            db.engine.dispose()
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(id=1, email="luke@rebels.com", password="x", is_active=True))
+        for planet_id in (1, 2, 3):
+            db.session.add(Planet(id=planet_id, name="Planet %d" % planet_id,
+                                  population=1000, climate="arid"))
+        db.session.add(People(id=1, name="Luke", birth_year=19, height=172,
+                              eye_color="blue", gender="male"))
+        db.session.commit()
+
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def queue(app, monkeypatch):
+    """A fresh write-behind queue plugged into the favorite endpoints."""
+    # The tests flush by hand, the background thread should never get there first
+    queue = FavoriteWriteQueue(app, flush_interval=3600)
+    monkeypatch.setattr(app_module, "favorite_queue", queue)
+    yield queue
+    queue.shutdown()
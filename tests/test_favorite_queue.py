@@ -0,0 +1,119 @@
+import pytest
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+import favorite_queue as favorite_queue_module
+from favorite_queue import ADD
+from models import Favorite
+
+
+def favorite_keys(client):
+    response = client.get("/users/favorites")
+    assert response.status_code == 200
+    return sorted((item["type"], item["data"]["id"]) for item in response.get_json())
+
+
+def stored_keys(app):
+    with app.app_context():
+        return sorted(
+            ("planet", fav.planet_id) if fav.planet_id else ("people", fav.people_id)
+            for fav in Favorite.query.all()
+        )
+
+
+def test_enqueue_cancel_flush_and_failed_flush(app, client, queue):
+    assert client.post("/favorite/planet/1").status_code == 202
+    assert client.post("/favorite/planet/2").status_code == 202
+    assert client.post("/favorite/planet/1").status_code == 409
+
+    # Add and delete before the flush cancel out
+    assert client.post("/favorite/people/1").status_code == 202
+    assert client.delete("/favorite/people/1").status_code == 202
+    assert client.delete("/favorite/people/1").status_code == 404
+
+    # Nothing written yet, but GET already shows the pending changes
+    assert stored_keys(app) == []
+    assert favorite_keys(client) == [("planet", 1), ("planet", 2)]
+
+    assert queue.flush() == 2
+    assert stored_keys(app) == [("planet", 1), ("planet", 2)]
+
+    # The planet disappears before its favorite is written: that add fails
+    # the batch, the delete of planet 2 still has to go through
+    assert client.delete("/favorite/planet/2").status_code == 202
+    assert client.post("/favorite/planet/3").status_code == 202
+    assert client.delete("/planets/3").status_code == 200
+    assert favorite_keys(client) == [("planet", 1)]
+
+    assert queue.flush() == 1
+    assert stored_keys(app) == [("planet", 1)]
+    assert queue.pending_ops(1) == {}
+    assert favorite_keys(client) == [("planet", 1)]
+
+
+def test_unavailable_database_requeues_until_max_retries(app, client, queue, monkeypatch):
+    def database_down(batch):
+        raise OperationalError("INSERT", {}, Exception("database is down"))
+
+    assert client.post("/favorite/planet/1").status_code == 202
+
+    with monkeypatch.context() as m:
+        m.setattr(queue, "_commit", database_down)
+        assert queue.flush() == 0
+        assert favorite_keys(client) == [("planet", 1)]
+
+    assert queue.flush() == 1
+    assert stored_keys(app) == [("planet", 1)]
+
+    assert client.post("/favorite/planet/2").status_code == 202
+    monkeypatch.setattr(queue, "_commit", database_down)
+    for _ in range(favorite_queue_module.MAX_RETRIES + 1):
+        queue.flush()
+    assert queue.pending_ops(1) == {}
+    assert favorite_keys(client) == [("planet", 1)]
+
+
+def test_shutdown_flushes_pending(app, client, queue):
+    assert client.post("/favorite/planet/1").status_code == 202
+    assert client.post("/favorite/people/1").status_code == 202
+
+    queue.shutdown()
+
+    assert stored_keys(app) == [("people", 1), ("planet", 1)]
+    assert queue.pending_ops(1) == {}
+
+
+def test_unexpected_error_requeues_and_clears_inflight(app, client, queue, monkeypatch):
+    def broken(batch):
+        raise RuntimeError("boom")
+
+    assert client.post("/favorite/planet/1").status_code == 202
+
+    with monkeypatch.context() as m:
+        m.setattr(queue, "_commit", broken)
+        with pytest.raises(RuntimeError):
+            queue.flush()
+
+    # Still queued (not stuck in flight), so it's still a favorite and
+    # the next flush writes it
+    assert queue.pending_ops(1) == {("planet", 1): ADD}
+    assert client.post("/favorite/planet/1").status_code == 409
+    assert favorite_keys(client) == [("planet", 1)]
+
+    assert queue.flush() == 1
+    assert stored_keys(app) == [("planet", 1)]
+    assert queue.pending_ops(1) == {}
+
+
+def test_pool_timeout_requeues(app, client, queue, monkeypatch):
+    def no_connection(batch):
+        raise TimeoutError("QueuePool limit reached")
+
+    assert client.post("/favorite/planet/1").status_code == 202
+
+    with monkeypatch.context() as m:
+        m.setattr(queue, "_commit", no_connection)
+        assert queue.flush() == 0
+    assert queue.pending_ops(1) == {("planet", 1): ADD}
+
+    assert queue.flush() == 1
+    assert stored_keys(app) == [("planet", 1)]
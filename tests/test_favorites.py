@@ -0,0 +1,23 @@
+from models import Favorite
+
+
+def test_favorites_are_committed_right_away_by_default(app, client):
+    assert client.post("/favorite/planet/1").status_code == 200
+    assert client.post("/favorite/planet/1").status_code == 409
+    assert client.post("/favorite/people/1").status_code == 200
+    assert client.post("/favorite/planet/9").status_code == 404
+
+    with app.app_context():
+        assert Favorite.query.count() == 2
+
+    response = client.get("/users/favorites")
+    assert response.status_code == 200
+    assert sorted((item["type"], item["data"]["id"]) for item in response.get_json()) == [
+        ("people", 1), ("planet", 1)]
+
+    assert client.delete("/favorite/planet/1").status_code == 200
+    assert client.delete("/favorite/planet/1").status_code == 404
+    assert client.delete("/favorite/people/1").status_code == 200
+
+    with app.app_context():
+        assert Favorite.query.count() == 0
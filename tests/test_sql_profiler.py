@@ -0,0 +1,65 @@
+import logging
+
+import pytest
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
+
+from models import db, User
+
+
+def test_profiled_request_logs_rows_and_plan_but_not_parameters(app, client, monkeypatch, caplog):
+    monkeypatch.setitem(app.config, "SQL_PROFILER", True)
+    monkeypatch.setitem(app.config, "SQL_SLOW_QUERY_MS", 0)
+    monkeypatch.setitem(app.config, "SQL_SLOW_REQUEST_MS", 0)
+    caplog.set_level(logging.WARNING, logger="sql_profiler")
+
+    response = client.post("/users", json={"email": "leia@rebels.com", "password": "hunter2"})
+    assert response.status_code == 201
+    assert "X-SQL-Profile" in response.headers
+    assert "hunter2" not in caplog.text
+
+    response = client.get("/planets")
+    assert response.status_code == 200
+    assert response.headers["X-SQL-Profile"].startswith("queries=1;")
+    # sqlite doesn't report the row count of a SELECT, the ORM result does
+    assert "rows=3 SELECT" in caplog.text
+    assert "SCAN planet" in caplog.text
+
+
+def test_profiler_is_off_by_default(client):
+    response = client.get("/planets", headers={"X-SQL-Profile": "1"})
+    assert "X-SQL-Profile" not in response.headers
+
+
+def profile_of(app, run):
+    with app.test_request_context():
+        g.sql_profile = {"start": 0, "queries": []}
+        try:
+            run()
+        finally:
+            db.session.rollback()
+        return g.pop("sql_profile")["queries"]
+
+
+def test_rows_are_counted_on_the_statement_that_returned_them(app, client):
+    for planet_id in (1, 2, 3):
+        assert client.post("/favorite/planet/%d" % planet_id).status_code == 200
+
+    queries = profile_of(app, lambda: User.query.options(selectinload(User.favorites)).all())
+
+    # The selectin query runs while the main result is being counted
+    assert [q["rows"] for q in queries] == [1, 3]
+
+
+def test_failed_statement_is_recorded(app):
+    def broken():
+        with pytest.raises(OperationalError):
+            db.session.execute(text("SELECT * FROM no_such_table"))
+        db.session.execute(text("SELECT 1"))
+
+    queries = profile_of(app, broken)
+
+    assert [q.get("error") for q in queries] == ["OperationalError", None]
+    assert queries[0]["statement"] == "SELECT * FROM no_such_table"